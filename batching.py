@@ -0,0 +1,107 @@
+import fitz  # PyMuPDF
+import numpy as np
+
+from util import random_font, rewrite_page, single_page_copy
+
+
+def fit_crop(dl, bbox, bbox_dpi, shape, policy="letterbox", fill=255):
+    """Render a bbox of a page directly at the size of the target shape.
+
+    The render matrix is chosen so that the crop comes out at the target
+    scale, no resampling of a high resolution raster is needed.
+
+    Args:
+        dl: fitz.DisplayList of the (modified) page
+        bbox: (x1, y1, x2, y2) in pixels at bbox_dpi
+        bbox_dpi: resolution of bbox
+        shape: target (height, width)
+        policy: "letterbox" scales to fit keeping the aspect ratio and pads
+            centered; "stretch" scales x and y independently to fill the
+            target; "pad" keeps the bbox_dpi scale and pads (or cuts) at
+            the bottom and right.
+        fill: gray value of the padding
+    Returns:
+        (height, width, 3) uint8 array.
+    """
+    height, width = shape
+    rect = fitz.Rect(bbox) * (72 / bbox_dpi)  # page coordinates
+    out = np.full((height, width, 3), fill, dtype=np.uint8)
+    if rect.is_empty:
+        return out
+    sx = width / rect.width  # pixels per point
+    sy = height / rect.height
+    if policy == "letterbox":
+        sx = sy = min(sx, sy)
+    elif policy == "pad":
+        sx = sy = bbox_dpi / 72
+    elif policy != "stretch":
+        raise ValueError("Invalid policy: %s" % policy)
+
+    matrix = fitz.Matrix(sx, sy)
+    clip = rect & dl.rect  # MuPDF does not render outside of the page
+    if clip.is_empty:
+        return out
+    pixmap = dl.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+    array = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+
+    irect = (rect * matrix).round()  # the whole bbox in pixels, rounded as MuPDF does
+    top = left = 0
+    if policy == "letterbox":
+        top = (height - min(irect.height, height)) // 2
+        left = (width - min(irect.width, width)) // 2
+    top += pixmap.y - irect.y0  # the page part starts at its offset in the bbox
+    left += pixmap.x - irect.x0
+    # rounding of the pixmap size may add a pixel, cut what does not fit
+    array = array[max(0, -top):height - top, max(0, -left):width - left]
+    top, left = max(top, 0), max(left, 0)
+    out[top:top + array.shape[0], left:left + array.shape[1]] = array
+    return out
+
+
+def replace_font_batch(indoc, items, font_name, shape, bbox_dpi, policy="letterbox", mode="word",
+                       normalize=None, fill=255):
+    """Replace fonts and return the crops as one training batch.
+
+    Every page is rewritten once (in a single-page copy, the caller's
+    document is not modified) and all of its crops are rendered from one
+    display list at the scale of the target shape.
+
+    Args:
+        indoc: input PDF document
+        items: list of (page_num, bbox), bbox in pixels at bbox_dpi
+        font_name: font name to replace
+        shape: target (height, width) of every crop
+        bbox_dpi: resolution of the bboxes
+        policy: "letterbox", "stretch" or "pad", see fit_crop
+        mode: "word", "line" or "adaptive"
+        normalize: optional (mean, std), either floats or per-channel
+            sequences. Returns float32 (x / 255 - mean) / std instead of
+            uint8.
+    Returns:
+        (batch, valid): batch is an (N, height, width, 3) array, valid an
+        (N,) bool array, False where the page could not be processed (that
+        crop is filled with the padding value).
+    """
+    assert isinstance(indoc, fitz.Document)
+    if font_name == "random":
+        font_name = random_font()
+
+    batch = np.full((len(items), shape[0], shape[1], 3), fill, dtype=np.uint8)
+    valid = np.zeros(len(items), dtype=bool)
+    pages = {}
+    for i, (page_num, bbox) in enumerate(items):
+        pages.setdefault(page_num, []).append((i, bbox))
+
+    for page_num, crops in pages.items():
+        page_doc = single_page_copy(indoc, page_num)
+        if not rewrite_page(mode, page_doc[0], font_name):
+            continue
+        dl = page_doc[0].get_displaylist()
+        for i, bbox in crops:
+            batch[i] = fit_crop(dl, bbox, bbox_dpi, shape, policy, fill)
+            valid[i] = True
+
+    if normalize is not None:
+        mean, std = normalize
+        batch = (batch.astype(np.float32) / 255 - np.asarray(mean, dtype=np.float32)) / np.asarray(std, dtype=np.float32)
+    return batch, valid
@@ -0,0 +1,245 @@
+import fitz  # PyMuPDF
+import numpy as np
+import os
+import tempfile
+import time
+import tracemalloc
+
+import font_replace_word
+import font_replace_line
+import font_replace_patch
+from util import extract_spans, split_words
+
+STRATEGIES = {
+    "word": font_replace_word.replace_font,
+    "line": font_replace_line.replace_font,
+    "patch": font_replace_patch.replace_font,
+}
+
+CHUNK = 512  # rows per chunk of the pairwise box computations
+
+
+def word_boxes(page):
+    """Return the word bboxes of a page as an (N, 4) float array."""
+    words = page.get_text("words")
+    if not words:
+        return np.zeros((0, 4))
+    return np.array([w[:4] for w in words], dtype=np.float64)
+
+
+def pairwise_iou(a, b):
+    """IoU matrix of the boxes in a (N, 4) and b (M, 4)."""
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0)
+
+
+def bbox_drift(orig, new):
+    """Match every original word to its best overlapping new word.
+
+    Returns:
+        (mean drift, lost): mean distance in points between the matched box
+        corners, and the fraction of original words without a match
+        (IoU < 0.5).
+    """
+    if len(orig) == 0:
+        return 0.0, 0.0
+    if len(new) == 0:
+        return float("nan"), 1.0
+    drift, lost = [], 0
+    for i in range(0, len(orig), CHUNK):
+        chunk = orig[i:i + CHUNK]
+        iou = pairwise_iou(chunk, new)
+        best = iou.argmax(axis=1)
+        matched = iou[np.arange(len(chunk)), best] >= 0.5
+        lost += int((~matched).sum())
+        dist = np.abs(chunk[matched] - new[best[matched]]).max(axis=1)
+        drift.append(dist)
+    drift = np.concatenate(drift)
+    return (float(drift.mean()) if len(drift) else float("nan")), lost / len(orig)
+
+
+def overlap_count(boxes, min_area=0.5):
+    """Count pairs of words whose bboxes intersect by more than min_area."""
+    count = 0
+    for i in range(0, len(boxes), CHUNK):
+        chunk = boxes[i:i + CHUNK]
+        x0 = np.maximum(chunk[:, None, 0], boxes[None, :, 0])
+        y0 = np.maximum(chunk[:, None, 1], boxes[None, :, 1])
+        x1 = np.minimum(chunk[:, None, 2], boxes[None, :, 2])
+        y1 = np.minimum(chunk[:, None, 3], boxes[None, :, 3])
+        inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+        rows = np.arange(i, i + len(chunk))[:, None]
+        cols = np.arange(len(boxes))[None, :]
+        count += int(((inter > min_area) & (cols > rows)).sum())  # each pair once
+    return count
+
+
+def page_array(page, dpi):
+    pixmap = page.get_pixmap(dpi=dpi)
+    return np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+
+
+def outside_text_diff(orig_page, new_page, boxes, dpi=72):
+    """Mean absolute pixel difference outside of the text regions.
+
+    Args:
+        boxes: word bboxes (PDF coordinates) masking the text regions.
+    Returns:
+        (mean diff, changed): mean absolute difference in [0, 255] and the
+        fraction of pixels differing by more than 32.
+    """
+    a = page_array(orig_page, dpi).astype(np.int16)
+    b = page_array(new_page, dpi).astype(np.int16)
+    h, w = min(a.shape[0], b.shape[0]), min(a.shape[1], b.shape[1])
+    a, b = a[:h, :w], b[:h, :w]
+    mask = np.ones((h, w), dtype=bool)  # True = outside of text
+    scale = dpi / 72
+    px = np.round(boxes * scale).astype(int)
+    px[:, :2] -= 1  # grow by one pixel for antialiasing
+    px[:, 2:] += 1
+    px = np.clip(px, 0, [w, h, w, h])
+    for x0, y0, x1, y1 in px:
+        mask[y0:y1, x0:x1] = False
+    if not mask.any():
+        return 0.0, 0.0
+    diff = np.abs(a - b).max(axis=2)[mask]
+    return float(diff.mean()), float((diff > 32).mean())
+
+
+def measure(pdf_path, output_path, strategy, font_name, dpi=72):
+    """Run one strategy on one document and compute its quality metrics."""
+    t0 = time.perf_counter()
+    failed = STRATEGIES[strategy](pdf_path, output_path, font_name) is False
+    elapsed = time.perf_counter() - t0
+
+    indoc = fitz.open(pdf_path)
+    row = {
+        "file": os.path.basename(pdf_path),
+        "strategy": strategy,
+        "font": font_name,
+        "pages": indoc.page_count,
+        "sec_per_page": elapsed / max(indoc.page_count, 1),
+        "size_kb": float("nan"),
+        "drift": float("nan"),
+        "lost": float("nan"),
+        "overlaps": float("nan"),
+        "pixel_diff": float("nan"),
+        "changed": float("nan"),
+    }
+    if failed or not os.path.isfile(output_path):  # strategy failed on this document
+        return row
+    row["size_kb"] = os.path.getsize(output_path) / 1024
+
+    outdoc = fitz.open(output_path)
+    drift, lost, overlaps, pixel_diff, changed = [], [], [], [], []
+    for orig_page, new_page in zip(indoc, outdoc):
+        orig = word_boxes(orig_page)
+        new = word_boxes(new_page)
+        d, l = bbox_drift(orig, new)
+        drift.append(d)
+        lost.append(l)
+        overlaps.append(overlap_count(new) - overlap_count(orig))  # new overlaps only
+        boxes = np.concatenate([orig, new])
+        p, c = outside_text_diff(orig_page, new_page, boxes, dpi=dpi)
+        pixel_diff.append(p)
+        changed.append(c)
+    row.update(
+        drift=float(np.nanmean(drift)) if drift else 0.0,
+        lost=float(np.mean(lost)) if lost else 0.0,
+        overlaps=int(np.sum(overlaps)),
+        pixel_diff=float(np.mean(pixel_diff)) if pixel_diff else 0.0,
+        changed=float(np.mean(changed)) if changed else 0.0,
+    )
+    return row
+
+
+def run_benchmark(pdf_paths, font_names, strategies=("word", "line", "patch"), output_dir=None):
+    """Run every strategy on every document and font.
+
+    Returns:
+        list of result rows (dicts), one per (document, strategy, font).
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = output_dir or tmp_dir
+        rows = []
+        for pdf_path in pdf_paths:
+            for strategy in strategies:
+                for font_name in font_names:
+                    output_path = os.path.join(output_dir, f"{strategy}_{font_name}_{os.path.basename(pdf_path)}")
+                    if os.path.isfile(output_path):
+                        os.remove(output_path)
+                    rows.append(measure(pdf_path, output_path, strategy, font_name))
+        return rows
+
+
+def compare_extraction(pdf_paths, backends=("rawdict", "texttrace")):
+    """Measure time and peak Python allocation of the extraction backends.
+
+    Extraction and word segmentation run for every page, just like
+    replace_page_word does.
+
+    Returns:
+        list of result rows (dicts), one per (document, backend).
+    """
+    rows = []
+    for pdf_path in pdf_paths:
+        indoc = fitz.open(pdf_path)
+        for backend in backends:
+            words = 0
+            t0 = time.perf_counter()
+            for page in indoc:
+                for span in extract_spans(page, backend):
+                    words += len(split_words(span))
+            elapsed = time.perf_counter() - t0
+
+            peak = 0  # separate pass, tracing slows down the timing
+            for page in indoc:
+                tracemalloc.start()
+                spans = extract_spans(page, backend)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                del spans
+            rows.append({
+                "file": os.path.basename(pdf_path),
+                "backend": backend,
+                "pages": indoc.page_count,
+                "sec_per_page": elapsed / max(indoc.page_count, 1),
+                "peak_kb": peak / 1024,
+                "words": words,
+            })
+    return rows
+
+
+def format_table(rows):
+    """Format result rows as a plain text table."""
+    columns = list(rows[0].keys()) if rows else []
+
+    def fmt(value):
+        if isinstance(value, float):
+            return "%.4g" % value
+        return str(value)
+
+    cells = [columns] + [[fmt(row[c]) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(line, widths)) for line in cells]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    base_path = "/shared/workspace/0516_TableTestSet/51-100/pdfs/"
+    pdfs = [base_path + pdf for pdf in os.listdir(base_path)]
+    styles = ["times-bolditalic", "helv", "cour"]
+
+    rows = run_benchmark(pdfs, styles)
+    print(format_table(rows))
+    print()
+    print(format_table(compare_extraction(pdfs)))
@@ -0,0 +1,74 @@
+import fitz  # PyMuPDF
+import time
+
+from util import BudgetExceeded, random_font, rewrite_page, render_crops, single_page_copy
+
+
+def replace_font_budgeted(indoc, page_nums, bbox, font_name, dpi, page_budget=60, doc_budget=None,
+                          modes=("word", "line"), bbox_dpi=None, backend="rawdict"):
+    """Replace fonts page by page within time budgets.
+
+    Each page is tried with the modes in order, all within the page budget.
+    The time left is split evenly among the modes not tried yet, time a mode
+    does not use passes on to the next one. When a mode runs past its share
+    or cannot process the page, the page falls back to the next (cheaper)
+    mode; when all modes fail or the document budget is used up, the page is
+    skipped.
+    Pages are rewritten in single-page copies, so an aborted attempt never
+    leaves a half-cleaned page behind and the caller's document is not
+    modified.
+
+    The budget is checked between processing steps and inside the loops of
+    cont_clean and text writing. A single MuPDF call (text extraction,
+    rendering) is not interrupted.
+
+    Args:
+        indoc: input PDF document
+        page_nums: list of page numbers
+        page_budget: seconds for all attempts of a page
+        doc_budget: seconds for all pages of the document (optional)
+        modes: modes to try, most faithful first
+    Returns:
+        (images, report): images has one entry per page (None if skipped),
+        report one dict per page with "page", "mode", "seconds" and
+        "reason" (empty if a mode succeeded).
+    """
+    assert isinstance(indoc, fitz.Document)
+    if font_name == "random":
+        font_name = random_font()
+
+    doc_deadline = time.monotonic() + doc_budget if doc_budget is not None else None
+    images, report = [], []
+    for page_num in page_nums:
+        t0 = time.monotonic()
+        entry = {"page": page_num, "mode": None, "seconds": 0.0, "reason": ""}
+        image = None
+        reasons = []
+        page_deadline = t0 + page_budget
+        if doc_deadline is not None:
+            page_deadline = min(page_deadline, doc_deadline)
+        for i, mode in enumerate(modes):
+            now = time.monotonic()
+            if doc_deadline is not None and now >= doc_deadline:
+                reasons.append("document budget exceeded")
+                break
+            deadline = now + (page_deadline - now) / (len(modes) - i)  # share of the time left
+            page_doc = single_page_copy(indoc, page_num)
+            try:
+                if not rewrite_page(mode, page_doc[0], font_name, backend, deadline):
+                    reasons.append("%s: cannot process page" % mode)
+                    continue
+            except BudgetExceeded:
+                reasons.append("%s: page budget exceeded" % mode)
+                continue
+            image = render_crops(page_doc[0], bbox, dpi, bbox_dpi)
+            entry["mode"] = mode
+            break
+        entry["seconds"] = time.monotonic() - t0
+        if image is None:
+            entry["reason"] = "; ".join(reasons)
+        elif reasons:  # succeeded after fallback, keep why
+            entry["reason"] = "fallback after " + "; ".join(reasons)
+        images.append(image)
+        report.append(entry)
+    return images, report
@@ -1,6 +1,10 @@
 import fitz  # PyMuPDF
 import os
 
+from util import save_document, save_report
+
+DEFAULT_SAVE = {"garbage": 4, "deflate": False}  # used without a profile
+
 def recolor(old):
     """Convet sRGB color back to PDF color triple.
     sRGB is an integer of format RRGGBB.
@@ -21,8 +25,9 @@ def resize(span, font):
     return new_size
     
 
-def replace_font(pdf_path, output_path, font_name):
-    indoc = fitz.open(pdf_path)
+def replace_font(pdf_path, output_path, font_name, profile=None):
+    # pdf_path may also be an open fitz.Document
+    indoc = pdf_path if isinstance(pdf_path, fitz.Document) else fitz.open(pdf_path)
     pdfdata = indoc.tobytes()
     outdoc = fitz.open("pdf", pdfdata)
 
@@ -63,7 +68,8 @@ def replace_font(pdf_path, output_path, font_name):
                     )
 
     # Save the modified PDF
-    outdoc.save(output_path, garbage=4, deflate=False)
+    # save profile: "fast", "compact" (see util.SAVE_PROFILES) or save arguments
+    return save_document(outdoc, output_path, profile or DEFAULT_SAVE)
 
 if __name__ == "__main__":
 
@@ -99,3 +105,5 @@ if __name__ == "__main__":
             print(f"Processing [file: {pdf}] [font: {font_name}]")
             output_path = f"./example_patch/{font_name}_{pdf}"
             replace_font(pdf_path, output_path, font_name)
+
+    print(save_report())
@@ -2,6 +2,11 @@ import fitz  # PyMuPDF
 from PIL import Image, ImageDraw
 import os
 
+from incremental import page_fingerprints, reusable_pages, save_fingerprints, splice_pages
+from util import save_document, save_report, write_text_merged
+
+DEFAULT_SAVE = {"garbage": 4, "deflate": True}  # used without a profile
+
 def recolor(old):
     """Convet sRGB color back to PDF color triple.
     sRGB is an integer of format RRGGBB.
@@ -144,12 +149,25 @@ def get_page_fontrefs(page, font_name):
     return fontrefs  # return list of font reference names
 
 
-def replace_font(pdf_path, output_path, font_name):
-    indoc = fitz.open(pdf_path)
+def replace_font(pdf_path, output_path, font_name, profile=None, incremental=False):
+    # pdf_path may also be an open fitz.Document, which is modified in place
+    # Returns False if the file cannot be processed (nothing is saved)
+    indoc = pdf_path if isinstance(pdf_path, fitz.Document) else fitz.open(pdf_path)
     extr_flags = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE
     font = fitz.Font(font_name)
 
+    # incremental: pages unchanged since the previous output at output_path
+    # (same font, see its .fingerprints.json) are spliced in, not rewritten
+    fingerprints, reuse = None, {}
+    if incremental and isinstance(output_path, str) and os.path.abspath(output_path) != os.path.abspath(indoc.name or ""):
+        fingerprints = page_fingerprints(indoc)  # before any page is modified
+        reuse = reusable_pages(output_path, fingerprints, font_name, "word")
+        if not splice_pages(indoc, output_path, reuse):
+            reuse = {}
+
     for page in indoc:
+        if page.number in reuse:  # spliced from the previous output
+            continue
         # extract text again
         blocks = page.get_text("rawdict", flags=extr_flags)["blocks"]
 
@@ -161,7 +179,7 @@ def replace_font(pdf_path, output_path, font_name):
         valid = cont_clean(page, fontrefs)  # remove text using fonts to be replaced
         if not valid:
             print("Cannot process this file.", pdf_path)
-            return
+            return False  # nothing saved, the output is not written
         textwriters = {}  # contains one text writer per detected text color
 
         for block in blocks:
@@ -213,16 +231,13 @@ def replace_font(pdf_path, output_path, font_name):
                             print("page %i exception:" % page.number, text)
 
         # now write all text stored in the list of text writers
-        for color in textwriters.keys():  # output the stored text per color
-            tw = textwriters[color]
-            outcolor = fitz.sRGB_to_pdf(color)  # recover (r,g,b)
-            tw.write_text(page, color=outcolor)
+        write_text_merged(page, textwriters)  # one content stream for all colors
 
-    indoc.save(
-        output_path,
-        garbage=4,
-        deflate=True,
-    )
+    # save profile: "fast", "compact" (see util.SAVE_PROFILES) or save arguments
+    data = save_document(indoc, output_path, profile or DEFAULT_SAVE)
+    if isinstance(output_path, str):  # rewrite or remove the sidecar of the output
+        save_fingerprints(output_path, fingerprints, font_name, "word")
+    return data
 
 
 def draw_bbox_pdf(pdf_path,page, output):
@@ -283,3 +298,4 @@ if __name__ == "__main__":
             output_path = f"./example_word/{font_name}_{pdf}"
             replace_font(pdf_path, output_path, font_name)
 
+    print(save_report())
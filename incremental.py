@@ -0,0 +1,167 @@
+import fitz  # PyMuPDF
+import hashlib
+import json
+import os
+import re
+
+from util import doc_hash
+
+FINGERPRINT_VERSION = 1  # bump when the rewriting of pages changes
+
+_REF = re.compile(r"(\d+) \d+ R")
+_PARENT = re.compile(r"/Parent \d+ \d+ R")
+
+
+def _text_digest(doc, text, memo, visiting):
+    """Hash a PDF object source together with all objects it references.
+
+    Object numbers are left out, so a renumbered but otherwise identical
+    object gets the same digest.
+    """
+    text = _PARENT.sub("", text)  # the page tree is not part of the content
+    sha = hashlib.sha1(_REF.sub("R", text).encode())
+    for ref in _REF.findall(text):
+        sha.update(_object_digest(doc, int(ref), memo, visiting))
+    return sha.digest()
+
+
+def _object_digest(doc, xref, memo, visiting):
+    if xref in memo:
+        return memo[xref]
+    if xref in visiting or not 0 < xref < doc.xref_length():  # cycle or broken reference
+        return b""
+    visiting.add(xref)
+    sha = hashlib.sha1(_text_digest(doc, doc.xref_object(xref, compressed=True), memo, visiting))
+    if doc.xref_is_stream(xref):
+        sha.update(doc.xref_stream_raw(xref))
+    visiting.discard(xref)
+    memo[xref] = sha.digest()
+    return memo[xref]
+
+
+def page_fingerprints(doc):
+    """Fingerprint every page by its contents and the resources they use.
+
+    The fingerprint covers the content streams, the page resources (fonts
+    with their font files, XObjects, graphics states, ...) including
+    inherited ones, and the page geometry. Annotations are not included,
+    the rewriting keeps them as they are.
+
+    Returns:
+        list of hex digests, one per page.
+    """
+    memo = {}  # xref -> digest, objects shared by pages are hashed once
+    fingerprints = []
+    for page in doc:
+        sha = hashlib.sha1(("%s %s %i" % (tuple(page.mediabox), tuple(page.cropbox), page.rotation)).encode())
+        for xref in page.get_contents():
+            sha.update(_object_digest(doc, xref, memo, set()))
+        xref = page.xref
+        kind, value = doc.xref_get_key(xref, "Resources")
+        while kind == "null":  # inherited from the page tree
+            kind, parent = doc.xref_get_key(xref, "Parent")
+            if kind != "xref":
+                break
+            xref = int(parent.split()[0])
+            kind, value = doc.xref_get_key(xref, "Resources")
+        sha.update(_text_digest(doc, value, memo, set()))
+        fingerprints.append(sha.hexdigest())
+    return fingerprints
+
+
+def fingerprint_path(output_path):
+    """Sidecar file of an output, holding the fingerprints of its source."""
+    return output_path + ".fingerprints.json"
+
+
+def save_fingerprints(output_path, fingerprints, font_name, mode):
+    """Write the sidecar of a freshly saved output.
+
+    With fingerprints None (the output was not made incrementally), a
+    sidecar left from an earlier output is removed instead: it describes a
+    different PDF now.
+    """
+    path = fingerprint_path(output_path)
+    if fingerprints is None:
+        if os.path.isfile(path):
+            os.remove(path)
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": FINGERPRINT_VERSION, "font": font_name, "mode": mode,
+                   "output": doc_hash(output_path), "pages": fingerprints}, f)
+    os.replace(tmp_path, path)  # never leave a truncated sidecar
+
+
+def reusable_pages(output_path, fingerprints, font_name, mode):
+    """Match pages to the pages of a previous output of the same font and mode.
+
+    Pages are matched by fingerprint, not by number, so pages inserted or
+    appended in a revision do not invalidate the pages after them. The
+    sidecar is only trusted if the output file is still the one it was
+    written for.
+
+    Returns:
+        dict of page number -> page number in the previous output, empty if
+        there is no usable previous output.
+    """
+    path = fingerprint_path(output_path)
+    if not (os.path.isfile(path) and os.path.isfile(output_path)):
+        return {}
+    try:
+        with open(path, "r") as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if (previous.get("version"), previous.get("font"), previous.get("mode")) != (FINGERPRINT_VERSION, font_name, mode):
+        return {}
+    if previous.get("output") != doc_hash(output_path):  # output replaced since
+        return {}
+    old_pages = {}
+    for old_num, fingerprint in enumerate(previous["pages"]):
+        old_pages.setdefault(fingerprint, old_num)
+    return {page_num: old_pages[fingerprint] for page_num, fingerprint in enumerate(fingerprints)
+            if fingerprint in old_pages}
+
+
+def splice_pages(doc, output_path, reuse):
+    """Copy the rewritten pages of the previous output into doc.
+
+    The /Contents and /Resources of the reused pages are replaced by the
+    ones of the previous output, everything else (annotations, links,
+    outline) stays as in doc. Objects shared by several pages are copied
+    once.
+
+    Returns:
+        False if the previous output cannot be read, doc is then unchanged.
+    """
+    if not reuse:
+        return True
+    try:
+        prev = fitz.open(output_path)
+    except Exception as e:
+        print("Cannot reuse previous output %s: %s" % (output_path, e))
+        return False
+    if prev.page_count <= max(reuse.values()):
+        return False
+    mupdf = fitz.mupdf
+    pdf = fitz._as_pdf_document(doc)
+    prev_pdf = fitz._as_pdf_document(prev)
+    graft_map = mupdf.pdf_new_graft_map(pdf)
+    first_new = doc.xref_length()
+    for page_num, old_num in sorted(reuse.items()):
+        page_obj = mupdf.pdf_lookup_page_obj(pdf, page_num)
+        old_obj = mupdf.pdf_lookup_page_obj(prev_pdf, old_num)
+        for key in ("Contents", "Resources"):
+            name = mupdf.pdf_new_name(key)
+            mupdf.pdf_dict_put(page_obj, name, mupdf.pdf_graft_mapped_object(
+                graft_map, mupdf.pdf_dict_get_inheritable(old_obj, name)))
+    prev.close()  # the output file is about to be overwritten
+
+    # Font files come in compressed, the same font written to the changed
+    # pages is not. Store them uncompressed (save compresses again), so that
+    # garbage collection finds the duplicate and keeps one copy.
+    for xref in range(first_new, doc.xref_length()):
+        if doc.xref_is_stream(xref) and doc.xref_get_key(xref, "Length1")[0] != "null":
+            doc.update_stream(xref, doc.xref_stream(xref), compress=False)
+    return True
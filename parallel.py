@@ -0,0 +1,200 @@
+import fitz  # PyMuPDF
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import queue
+
+from util import process, preload_fonts
+
+
+class RasterRing:
+    """Ring buffer of fixed-size raster slots in shared memory.
+
+    Workers copy their rasters into a free slot and only send a small
+    descriptor back; the consumer maps the slot as a NumPy array without
+    copying.
+    """
+
+    def __init__(self, n_slots, slot_bytes, name=None):
+        self.n_slots = n_slots
+        self.slot_bytes = slot_bytes
+        if name is None:  # owner: create the buffer
+            self.shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_bytes)
+            self.owner = True
+        else:  # worker: attach to an existing buffer
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+
+    def write(self, slot, array):
+        """Copy array into slot and return its descriptor."""
+        array = np.ascontiguousarray(array)
+        if array.nbytes > self.slot_bytes:
+            raise ValueError("raster of %i bytes exceeds slot size %i" % (array.nbytes, self.slot_bytes))
+        offset = slot * self.slot_bytes
+        target = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf, offset=offset)
+        target[...] = array
+        return {"slot": slot, "offset": offset, "shape": array.shape, "dtype": array.dtype.str}
+
+    def view(self, desc):
+        """Return a NumPy view of the raster described by desc (no copy)."""
+        return np.ndarray(desc["shape"], dtype=np.dtype(desc["dtype"]),
+                          buffer=self.shm.buf, offset=desc["offset"])
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:  # views still alive, the mapping goes with them
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker(worker, ring_name, n_slots, slot_bytes, mode, tasks, results, free_slots, current, held):
+    """Render crops for tasks and hand them over through the ring.
+
+    current[worker] and held[worker] hold the job index and the slot the
+    worker is busy with (-1 if none), so that the consumer can recover
+    them if the process dies.
+    """
+    ring = RasterRing(n_slots, slot_bytes, name=ring_name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:  # sentinel: no more work
+                break
+            index, pdf_path, page_num, bbox, font_name, dpi = task
+            current[worker] = index
+            desc = {"index": index, "page": page_num, "font": font_name, "dpi": dpi,
+                    "slot": None, "error": None}
+            try:
+                indoc = fitz.open(pdf_path)  # fresh copy, replacement modifies it
+                image = process(mode, (indoc, page_num, bbox, font_name, dpi))
+                indoc.close()
+                if image is None:
+                    desc["error"] = "cannot process page"
+                else:
+                    array = np.asarray(image)
+                    slot = free_slots.get()  # blocks until the consumer released one
+                    held[worker] = slot
+                    try:
+                        desc.update(ring.write(slot, array))
+                    except Exception:
+                        held[worker] = -1
+                        free_slots.put(slot)
+                        raise
+            except Exception as e:
+                desc["error"] = str(e)
+            # hand over before sending: a slot must never be returned twice
+            current[worker] = held[worker] = -1
+            results.put(desc)
+    finally:
+        ring.close()
+
+
+def replace_font_parallel(jobs, n_workers=4, mode="word", n_slots=None, slot_bytes=None,
+                          fonts=None, poll=1.0):
+    """Run replace_font over worker processes with shared-memory transport.
+
+    Args:
+        jobs: list of (pdf_path, page_num, bbox, font_name, dpi)
+        n_workers: number of worker processes
+        mode: "word" or "line"
+        n_slots: number of ring slots, defaults to 2 per worker
+        slot_bytes: size of a slot, defaults to the largest RGB bbox in jobs
+        fonts: font names to preload before the workers fork, defaults to
+            all supported fonts
+        poll: seconds between checks for dead workers
+    Yields:
+        (desc, array) in completion order. desc["index"] is the position in
+        jobs, array is a (H, W, 3) uint8 view into shared memory or None if
+        desc["error"] is set. The view is only valid until the next
+        iteration; copy it if it must outlive the loop.
+
+        A worker process that dies (crash in MuPDF, killed for memory) does
+        not block the loop: the job it was running, and once no worker is
+        left every job without a result, is yielded with an error.
+    """
+    if n_slots is None:
+        n_slots = 2 * n_workers
+    if slot_bytes is None:
+        # crop size as render_crops computes it, from the rounded coordinates
+        slot_bytes = max((round(b[2]) - round(b[0])) * (round(b[3]) - round(b[1])) * 3
+                         for (_, _, b, _, _) in jobs)
+    slot_bytes = max(slot_bytes, 1)
+
+    preload_fonts(fonts)  # inherited by the workers, no lazy loading there
+    # fork shares the loaded fonts copy-on-write; spawn must rebuild them
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else None)
+
+    ring = RasterRing(n_slots, slot_bytes)
+    tasks, results, free_slots = ctx.Queue(), ctx.Queue(), ctx.Queue()
+    for slot in range(n_slots):
+        free_slots.put(slot)
+    for index, job in enumerate(jobs):
+        tasks.put((index,) + tuple(job))
+    current = ctx.Array("i", [-1] * n_workers, lock=False)  # job index per worker
+    held = ctx.Array("i", [-1] * n_workers, lock=False)  # ring slot per worker
+    workers = []
+    for i in range(n_workers):
+        tasks.put(None)
+        w = ctx.Process(target=_worker,
+                       args=(i, ring.name, n_slots, slot_bytes, mode, tasks, results, free_slots,
+                             current, held),
+                       daemon=True)
+        w.start()
+        workers.append(w)
+
+    def lost(index, reason):
+        page_num, font_name, dpi = jobs[index][1], jobs[index][3], jobs[index][4]
+        return {"index": index, "page": page_num, "font": font_name, "dpi": dpi,
+                "slot": None, "error": reason}
+
+    done = set()  # job indices with a result
+    dead = set()  # workers found dead
+    try:
+        while len(done) < len(jobs):
+            try:
+                desc = results.get(timeout=poll)
+            except queue.Empty:
+                errors = []
+                found = False
+                for i, w in enumerate(workers):
+                    if i in dead or w.is_alive():
+                        continue
+                    dead.add(i)
+                    found = True
+                    if held[i] >= 0:  # died holding a slot
+                        free_slots.put(held[i])
+                        held[i] = -1
+                    if current[i] >= 0:
+                        errors.append(lost(current[i], "worker died (exit code %s)" % w.exitcode))
+                        current[i] = -1
+                if not found and len(dead) == len(workers):  # drained after the last exit
+                    errors = [lost(index, "no result, no worker left") for index in range(len(jobs))
+                              if index not in done]
+                for desc in errors:
+                    done.add(desc["index"])
+                    yield desc, None
+                continue
+            if desc["index"] in done:  # already reported as lost
+                if desc["slot"] is not None:
+                    free_slots.put(desc["slot"])
+                continue
+            done.add(desc["index"])
+            if desc["slot"] is None:
+                yield desc, None
+                continue
+            array = ring.view(desc)
+            try:
+                yield desc, array
+            finally:
+                del array  # drop our reference before the slot is reused
+                free_slots.put(desc["slot"])
+        for w in workers:
+            w.join()
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        ring.close()
@@ -0,0 +1,165 @@
+import fitz  # PyMuPDF
+import heapq
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+
+import font_replace_word
+import font_replace_line
+import font_replace_patch
+from prescan import scan_batch
+
+STRATEGIES = {
+    "word": font_replace_word.replace_font,
+    "line": font_replace_line.replace_font,
+    "patch": font_replace_patch.replace_font,
+}
+
+
+def plan_jobs(pdf_paths, font_names, n_workers=4, cache_path=None, mode="word"):
+    """Plan a batch run of every document with every font.
+
+    The cost of each page is estimated by the pre-scan from cheap metadata
+    (stream bytes, char counts) and summed per document. All fonts of a
+    document form one task, so the document is read once and processed
+    back-to-back on one worker. Tasks are assigned longest first to the
+    least loaded worker.
+
+    The whole-document scripts rewrite every page, so the plan works on
+    whole documents: there are no bboxes to group, and the page costs only
+    feed the document cost.
+
+    Args:
+        pdf_paths: list of PDF file paths
+        font_names: fonts to apply to every document
+        n_workers: number of worker processes of the run
+        cache_path: JSON file of cached pre-scan verdicts (optional)
+        mode: key of STRATEGIES, documents it cannot process are skipped
+    Returns:
+        plan dict with "workers" (one task list per worker), their
+        estimated "loads", the "skipped" documents with their reason and
+        the "mode" the plan was checked for.
+    """
+    todo, skipped = scan_batch(pdf_paths, cache_path, strategy=mode)  # most expensive first
+    workers = [[] for _ in range(n_workers)]
+    loads = [(0, i) for i in range(n_workers)]  # heap of (load, worker)
+    for pdf_path, verdict in todo:
+        cost = verdict["cost"] * len(font_names)
+        load, i = heapq.heappop(loads)
+        workers[i].append({"pdf_path": pdf_path, "fonts": list(font_names), "cost": cost,
+                           "page_costs": [info["cost"] for info in verdict["page_info"]]})
+        heapq.heappush(loads, (load + cost, i))
+    return {
+        "workers": workers,
+        "loads": [sum(task["cost"] for task in tasks) for tasks in workers],
+        "skipped": [{"pdf_path": p, "reason": "%s: %s" % (v["verdict"], v["reason"])} for p, v in skipped],
+        "mode": mode,
+    }
+
+
+def save_plan(plan, path):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=1)
+
+
+def load_plan(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _run_tasks(worker, tasks, output_dir, mode, results):
+    """Execute the tasks of one worker in order."""
+    replace_font = STRATEGIES[mode]
+    for task in tasks:
+        pdf_path = task["pdf_path"]
+        with open(pdf_path, "rb") as f:
+            pdfdata = f.read()  # read once for all fonts
+        for font_name in task["fonts"]:
+            t0 = time.perf_counter()
+            output_path = os.path.join(output_dir, f"{font_name}_{os.path.basename(pdf_path)}")
+            error = None
+            try:
+                # replace_font modifies the document, every font needs a fresh one
+                if replace_font(fitz.open("pdf", pdfdata), output_path, font_name) is False:
+                    error = "cannot process this file"  # output_path not written
+            except Exception as e:
+                error = str(e)
+            results.put({"worker": worker, "pdf_path": pdf_path, "font": font_name, "output_path": output_path,
+                         "seconds": time.perf_counter() - t0, "error": error})
+    results.put({"worker": worker, "done": True})
+
+
+def run_plan(plan, output_dir, mode=None, poll=1.0):
+    """Execute a plan with one process per worker of the plan.
+
+    A worker process that dies (crash in MuPDF, killed for memory) does not
+    block the run: its unfinished (document, font) pairs are reported with
+    an error.
+
+    Args:
+        mode: key of STRATEGIES, defaults to the mode of the plan
+        poll: seconds between checks for dead workers
+    Returns:
+        list of result dicts, one per (document, font), in completion order.
+    """
+    if mode is None:
+        mode = plan.get("mode", "word")
+    os.makedirs(output_dir, exist_ok=True)
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else None)
+    results = ctx.Queue()
+    workers = {}  # worker index -> process, until it is done
+    for i, tasks in enumerate(plan["workers"]):
+        if not tasks:
+            continue
+        w = ctx.Process(target=_run_tasks, args=(i, tasks, output_dir, mode, results))
+        w.start()
+        workers[i] = w
+
+    finished = set()  # (worker, pdf_path, font) with a result
+    result_list = []
+    running = dict(workers)
+    while running:
+        try:
+            result = results.get(timeout=poll)
+        except queue.Empty:
+            for i, w in list(running.items()):
+                if w.is_alive():
+                    continue
+                try:  # it may have finished right before dying
+                    result = results.get(timeout=poll)
+                    break
+                except queue.Empty:
+                    pass
+                for task in plan["workers"][i]:
+                    for font_name in task["fonts"]:
+                        if (i, task["pdf_path"], font_name) not in finished:
+                            result_list.append({
+                                "worker": i, "pdf_path": task["pdf_path"], "font": font_name,
+                                "output_path": None, "seconds": 0.0,
+                                "error": "no result, worker died (exit code %s)" % w.exitcode})
+                del running[i]
+            else:
+                continue
+        if result.get("done"):
+            running.pop(result["worker"], None)
+            continue
+        finished.add((result["worker"], result["pdf_path"], result["font"]))
+        result_list.append(result)
+    for w in workers.values():
+        w.join()
+    return result_list
+
+if __name__ == "__main__":
+
+    base_path = "/shared/workspace/0516_TableTestSet/51-100/pdfs/"
+    pdfs = [base_path + pdf for pdf in os.listdir(base_path)]
+    styles = ["times-bolditalic", "helv", "cour"]
+
+    plan = plan_jobs(pdfs, styles, n_workers=8, cache_path="./prescan_cache.json")
+    save_plan(plan, "./plan.json")
+    for item in plan["skipped"]:
+        print(f"Skipping [file: {item['pdf_path']}] [{item['reason']}]")
+    for result in run_plan(plan, "./example_word"):
+        print(f"Processed [file: {result['pdf_path']}] [font: {result['font']}] [{result['seconds']:.2f}s]")
@@ -0,0 +1,238 @@
+import fitz  # PyMuPDF
+import json
+import os
+import re
+
+from util import get_page_fontrefs, split_content, doc_hash
+
+# Verdicts of the pre-scan
+PROCESSABLE = "processable"
+UNSUPPORTED = "unsupported"  # font replacement would fail (e.g. cont_clean)
+IMAGE_ONLY = "image-only"  # no fonts, but images: scanned document
+NO_TEXT = "no-text"  # neither fonts nor images
+
+# Weights of the cost estimate. Units are arbitrary, only the ordering matters.
+COST_PER_PAGE = 1000
+COST_PER_CHAR = 20  # rawdict extraction + text writing
+COST_PER_STREAM_BYTE = 0.1  # content stream parsing
+COST_PER_REF_LINE = 0.05  # cont_clean is O(refs x lines)
+
+# Literal strings "(...)" and hex strings "<...>" shown by text operators
+STRING_RE = re.compile(rb"\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>")
+MATRIX_RE = re.compile(
+    rb"([-+]?[\d.]+)\s+([-+]?[\d.]+)\s+([-+]?[\d.]+)\s+([-+]?[\d.]+)\s+"
+    rb"[-+]?[\d.]+\s+[-+]?[\d.]+\s+(?:Tm|cm)"
+)
+SHOW_RE = re.compile(rb"(\[[^\]]*\]\s*TJ|\((?:\\.|[^\\)])*\)\s*(?:Tj|'|\")|<[0-9A-Fa-f\s]*>\s*(?:Tj|'|\"))")
+
+
+def split_lines(cont):
+    """Split a /Contents stream as the cont_clean of font_replace_word does.
+
+    Returns None if the stream is empty or not separated by newlines.
+    """
+    cont_lines = cont.splitlines()
+    if len(cont_lines) == 0 or cont_lines[0] == cont:
+        return None
+    return cont_lines
+
+
+# How each strategy splits the content streams it cleans, None if it does not
+# edit them. Streams the splitter rejects make the strategy fail.
+SPLITTERS = {
+    "util": split_content,  # util.replace_font, any mode
+    "word": split_lines,  # font_replace_word.py
+    "line": bytes.splitlines,  # font_replace_line.py, never fails
+    "patch": None,  # font_replace_patch.py covers the text instead
+}
+
+
+def estimate_chars(cont):
+    """Estimate the number of shown characters in a /Contents stream."""
+    count = 0
+    for show in SHOW_RE.findall(cont):
+        for string in STRING_RE.findall(show):
+            if string.startswith(b"<"):  # hex string: two digits per byte
+                count += len(re.sub(rb"\s", b"", string[1:-1])) // 2
+            else:
+                count += len(string) - 2
+    return count
+
+
+def has_rotated_text(cont):
+    """Check whether a /Contents stream sets a rotated or skewed matrix.
+
+    Both text matrices (Tm) and transformations (cm) are considered, so
+    rotated images are reported as well.
+    """
+    for a, b, c, d in MATRIX_RE.findall(cont):
+        try:
+            if abs(float(b)) > 1e-3 or abs(float(c)) > 1e-3:
+                return True
+        except ValueError:  # malformed number
+            continue
+    return False
+
+
+def scan_page(page, strategy="util"):
+    """Inspect a page without extracting its text layout.
+
+    Args:
+        page: the page
+        strategy: the font replacement that will run, a key of SPLITTERS
+    Returns:
+        dict with the number of fonts and images, content stream size, an
+        estimated char count, whether rotated text occurs and whether the
+        content streams can be processed by the cont_clean of strategy.
+    """
+    splitter = SPLITTERS[strategy]
+    doc = page.parent
+    fontrefs = get_page_fontrefs(page, None)  # every font counts
+    info = {
+        "fonts": len(page.get_fonts()),
+        "images": len(page.get_images()),
+        "stream_bytes": 0,
+        "chars": 0,
+        "rotated": False,
+        "splittable": True,
+        "ref_lines": 0,
+    }
+
+    xref_list = [(0, i) for i in page.get_contents()]
+    xref_list += [(xref, xref) for xref in fontrefs.keys() if xref != 0]
+    for (xref, xref0) in xref_list:
+        cont = doc.xref_stream(xref0) or b""
+        info["stream_bytes"] += len(cont)
+        info["chars"] += estimate_chars(cont)
+        if has_rotated_text(cont):
+            info["rotated"] = True
+        if splitter is None or xref not in fontrefs:  # stream is not touched by cont_clean
+            continue
+        cont_lines = splitter(cont)
+        if cont_lines is None:
+            info["splittable"] = False
+            continue
+        info["ref_lines"] += len(fontrefs[xref]) * len(cont_lines)
+    return info
+
+
+def scan_document(indoc, strategy="util"):
+    """Classify a document before running the expensive font replacement.
+
+    Args:
+        indoc: file path or fitz.Document
+        strategy: the font replacement that will run, a key of SPLITTERS
+    Returns:
+        dict with "verdict", "reason", estimated "cost" and per-page info.
+    """
+    if not isinstance(indoc, fitz.Document):
+        indoc = fitz.open(indoc)
+
+    result = {
+        "hash": doc_hash(indoc),
+        "pages": indoc.page_count,
+        "verdict": PROCESSABLE,
+        "reason": "",
+        "cost": 0,
+        "page_info": [],
+    }
+    if not indoc.is_pdf:
+        result.update(verdict=UNSUPPORTED, reason="not a PDF")
+        return result
+    if indoc.needs_pass:
+        result.update(verdict=UNSUPPORTED, reason="encrypted")
+        return result
+
+    cost = 0
+    for page in indoc:
+        info = scan_page(page, strategy)
+        info["cost"] = round(
+            COST_PER_PAGE
+            + COST_PER_CHAR * info["chars"]
+            + COST_PER_STREAM_BYTE * info["stream_bytes"]
+            + COST_PER_REF_LINE * info["ref_lines"]
+        )
+        cost += info["cost"]
+        result["page_info"].append(info)
+    result["cost"] = cost
+
+    pages = result["page_info"]
+    if any(not info["splittable"] for info in pages):
+        bad = [i for i, info in enumerate(pages) if not info["splittable"]]
+        result.update(verdict=UNSUPPORTED, reason="contents not separated by newlines on pages %s" % bad)
+    elif not any(info["fonts"] for info in pages):
+        if any(info["images"] for info in pages):
+            result.update(verdict=IMAGE_ONLY, reason="no fonts, images only")
+        else:
+            result.update(verdict=NO_TEXT, reason="no fonts")
+    return result
+
+
+class VerdictCache:
+    """Pre-scan verdicts persisted in a JSON file, keyed by strategy and content hash."""
+
+    def __init__(self, path):
+        self.path = path
+        self.verdicts = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.verdicts = json.load(f)
+
+    def get(self, key):
+        return self.verdicts.get(key)
+
+    def put(self, key, verdict):
+        self.verdicts[key] = verdict
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.verdicts, f)
+        os.replace(tmp_path, self.path)  # never leave a truncated cache
+
+
+def scan_batch(pdf_paths, cache_path=None, strategy="util"):
+    """Pre-scan a batch of documents, reusing cached verdicts.
+
+    Args:
+        pdf_paths: list of PDF file paths
+        cache_path: JSON file for persisted verdicts (optional)
+        strategy: the font replacement that will run, a key of SPLITTERS
+    Returns:
+        (todo, skipped): todo is a list of (path, verdict) of processable
+        documents, most expensive first. skipped lists the other ones.
+    """
+    cache = VerdictCache(cache_path) if cache_path else None
+    todo, skipped = [], []
+    for pdf_path in pdf_paths:
+        key = doc_hash(pdf_path)
+        cache_key = "%s:%s" % (strategy, key)  # verdicts differ per strategy
+        verdict = cache.get(cache_key) if cache else None
+        if verdict is None:
+            try:
+                verdict = scan_document(pdf_path, strategy)
+            except Exception as e:  # damaged files
+                verdict = {"hash": key, "pages": 0, "verdict": UNSUPPORTED,
+                           "reason": "cannot open: %s" % e, "cost": 0, "page_info": []}
+            if cache:
+                cache.put(cache_key, verdict)
+        if verdict["verdict"] == PROCESSABLE:
+            todo.append((pdf_path, verdict))
+        else:
+            skipped.append((pdf_path, verdict))
+    if cache:
+        cache.save()
+    todo.sort(key=lambda item: item[1]["cost"], reverse=True)  # longest first
+    return todo, skipped
+
+
+if __name__ == "__main__":
+
+    base_path = "/shared/workspace/0516_TableTestSet/51-100/pdfs/"
+    pdfs = [base_path + pdf for pdf in os.listdir(base_path)]
+
+    todo, skipped = scan_batch(pdfs, cache_path="./prescan_cache.json")
+    for pdf_path, verdict in skipped:
+        print(f"Skipping [file: {pdf_path}] [{verdict['verdict']}: {verdict['reason']}]")
+    for pdf_path, verdict in todo:
+        print(f"Processable [file: {pdf_path}] [pages: {verdict['pages']}] [cost: {verdict['cost']}]")
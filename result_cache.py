@@ -0,0 +1,151 @@
+import fitz  # PyMuPDF
+from PIL import Image
+from collections import OrderedDict
+import hashlib
+import os
+
+from util import doc_hash, random_font, rewrite_page, single_page_copy, is_bbox_list
+
+
+class ResultCache:
+    """Two-tier cache of rewritten page rasters.
+
+    Entries are keyed by (document content hash, page, font, strategy, dpi).
+    The memory tier holds PIL images, the disk tier PNG files. Both tiers
+    evict the least recently used entries once their size limit is reached.
+    """
+
+    def __init__(self, cache_dir=None, max_memory_bytes=512 << 20, max_disk_bytes=8 << 30):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()  # key -> image, least recently used first
+        self.memory_bytes = 0
+        self.disk = {}  # key -> (mtime, size) of the cached files
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            for entry in os.scandir(cache_dir):
+                if entry.name.endswith(".png"):
+                    stat = entry.stat()
+                    self.disk[entry.name[:-4]] = (stat.st_mtime, stat.st_size)
+                    self.disk_bytes += stat.st_size
+
+    @staticmethod
+    def make_key(content_hash, page_num, font_name, strategy, dpi):
+        key = "%s|%i|%s|%s|%s" % (content_hash, page_num, font_name, strategy, dpi)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".png")
+
+    def get(self, key):
+        """Return the cached page image or None."""
+        image = self.memory.get(key)
+        if image is not None:
+            self.memory.move_to_end(key)  # most recently used
+            self.hits += 1
+            return image
+        if key in self.disk:
+            try:
+                with Image.open(self._path(key)) as f:
+                    image = f.convert("RGB")
+                os.utime(self._path(key))  # mark as recently used
+                self.disk[key] = (os.path.getmtime(self._path(key)), self.disk[key][1])
+            except OSError:  # removed by another process
+                self.disk_bytes -= self.disk.pop(key)[1]
+                image = None
+            if image is not None:
+                self._put_memory(key, image)
+                self.hits += 1
+                return image
+        self.misses += 1
+        return None
+
+    def put(self, key, image):
+        """Store a page image in both tiers."""
+        self._put_memory(key, image)
+        if self.cache_dir:
+            self._put_disk(key, image)
+
+    def _put_memory(self, key, image):
+        if key in self.memory:
+            return
+        size = image.width * image.height * len(image.getbands())
+        self.memory[key] = image
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            _, old = self.memory.popitem(last=False)
+            self.memory_bytes -= old.width * old.height * len(old.getbands())
+
+    def _put_disk(self, key, image):
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)  # readers never see partial files
+        if key in self.disk:
+            self.disk_bytes -= self.disk[key][1]
+        size = os.path.getsize(path)
+        self.disk[key] = (os.path.getmtime(path), size)
+        self.disk_bytes += size
+        if self.disk_bytes > self.max_disk_bytes:
+            for old_key in sorted(self.disk, key=lambda k: self.disk[k][0]):
+                if self.disk_bytes <= self.max_disk_bytes or old_key == key:
+                    break
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+                self.disk_bytes -= self.disk.pop(old_key)[1]
+
+
+def crop(image, bbox, scale=1):
+    """Crop one bbox or a list of bboxes from a page image."""
+    bboxes = bbox if is_bbox_list(bbox) else [bbox]
+    crops = [image.crop(tuple(round(v * scale) for v in b)) for b in bboxes]
+    return crops if is_bbox_list(bbox) else crops[0]
+
+
+def cached_replace_font(indoc, page_num, bbox, font_name, dpi, mode="word", bbox_dpi=None, cache=None):
+    """Like util.replace_font, but serve the rewritten page from a cache.
+
+    The caller's document is not modified: the page is rewritten in a
+    single-page copy. The full page raster is cached and cropped on a hit.
+
+    Args:
+        cache: ResultCache, a fresh memory-only cache if omitted
+    Returns:
+        as util.replace_font, None if the page cannot be processed.
+    """
+    assert isinstance(indoc, fitz.Document)
+    assert isinstance(page_num, int)
+    page_num = indoc[page_num].number  # IndexError before anything is cached
+    if cache is None:
+        cache = ResultCache()
+    if font_name == "random":  # the key needs the actual font
+        font_name = random_font()
+
+    dpis = dpi if isinstance(dpi, (list, tuple)) else [dpi]
+    if bbox_dpi is None:
+        bbox_dpi = dpis[0]
+    content_hash = doc_hash(indoc)
+
+    page_doc = dl = None
+    results = []
+    for render_dpi in dpis:
+        key = cache.make_key(content_hash, page_num, font_name, mode, render_dpi)
+        image = cache.get(key)
+        if image is None:
+            if dl is None:  # rewrite once for all missing dpis
+                page_doc = single_page_copy(indoc, page_num)
+                if not rewrite_page(mode, page_doc[0], font_name):
+                    return None
+                dl = page_doc[0].get_displaylist()
+            zoom = render_dpi / 72
+            pixmap = dl.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
+            cache.put(key, image)
+        results.append(crop(image, bbox, render_dpi / bbox_dpi))
+    return results if isinstance(dpi, (list, tuple)) else results[0]
@@ -2,28 +2,83 @@ import fitz  # PyMuPDF
 from PIL import Image, ImageDraw
 import os
 import random
+import hashlib
+import time
 
-def random_font():
-    pymupdf_font = [
+PYMUPDF_FONTS = [
     "figo", "figbo", "figit", "figbi", 
     "fimo", "fimbo", "spacemo", "spacembo", 
     "spacemit", "spacembi", "notos", "notosbi",  
     "notosbo", "ubuntu", "ubuntubo",
     "ubuntubi", "ubuntuit", "ubuntm", "ubuntmbo", 
     "ubuntmbi", "ubuntmit", "cascadia", "cascadiab", 
-    "cascadiai", "cascadiabi"]
+    "cascadiai", "cascadiabi"] # 25 Fonts in PyMuPDF Default Font
 
-    base_font = [
+BASE_FONTS = [
     'courier', 'courier-oblique', 'courier-bold', 'courier-boldoblique', 
     'helvetica', 'helvetica-oblique', 'helvetica-bold', 'helvetica-boldoblique', 
     'times-roman', 'times-italic', 'times-bold', 'times-bolditalic', 
     'helv', 'heit', 'hebo', 'hebi', 
     'cour', 'coit', 'cobo', 'cobi', 
-    'tiro', 'tibo', 'tiit', 'tibi']
+    'tiro', 'tibo', 'tiit', 'tibi'] # 24 Fonts in PDF Base Font
+
+SUPPORTED_FONTS = PYMUPDF_FONTS + BASE_FONTS
+
+_font_registry = {}  # font name -> fitz.Font, shared by all calls
+_hash_memo = {}  # (path, size, mtime) -> content hash
+
+# adaptive mode: max. shift of a word start, in units of the fontsize
+ADAPTIVE_TOLERANCE = 0.1
+
+# texttrace backend: min. gap between two chars that separates words, in
+# units of the fontsize (the text is often spaced by TJ offsets, not blanks)
+TRACE_SPACE_GAP = 0.15
+
+
+class BudgetExceeded(Exception):
+    """Raised when processing a page runs past its deadline."""
+
+
+def check_deadline(deadline):
+    """Raise BudgetExceeded if the deadline (time.monotonic) has passed."""
+    if deadline is not None and time.monotonic() > deadline:
+        raise BudgetExceeded("time budget exceeded")
+
 
-    font_list = pymupdf_font + base_font
+def random_font():
     #choose random font in font_list
-    return font_list[random.randint(0, len(font_list)-1)]
+    return SUPPORTED_FONTS[random.randint(0, len(SUPPORTED_FONTS)-1)]
+
+
+def get_font(font_name):
+    """Return the cached fitz.Font for font_name, loading it on first use."""
+    font = _font_registry.get(font_name)
+    if font is None:
+        font = fitz.Font(font_name)
+        _font_registry[font_name] = font
+    return font
+
+
+def preload_fonts(font_names=None):
+    """Load fonts into the registry, by default all supported fonts.
+
+    Call this in the parent process before starting workers: forked workers
+    then share the loaded font buffers copy-on-write instead of building
+    them again.
+
+    Returns:
+        list of the font names that could be loaded.
+    """
+    if font_names is None:
+        font_names = SUPPORTED_FONTS
+    loaded = []
+    for font_name in font_names:
+        try:
+            get_font(font_name)
+            loaded.append(font_name)
+        except Exception as e:  # e.g. pymupdf-fonts not installed
+            print("Cannot load font %s: %s" % (font_name, e))
+    return loaded
 
 
 def get_dpi(indoc, orig_W, orig_H):
@@ -49,6 +104,111 @@ def resize(span, font):
     return new_size
     
     
+def sRGB_from_trace(span):
+    """Convert the color of a texttrace span to an sRGB integer."""
+    color = span["color"]
+    if len(color) == 1:  # gray
+        r = g = b = color[0]
+    elif len(color) == 4:  # CMYK
+        c, m, y, k = color
+        r, g, b = (1 - c) * (1 - k), (1 - m) * (1 - k), (1 - y) * (1 - k)
+    else:
+        r, g, b = color[:3]
+    return (round(r * 255) << 16) + (round(g * 255) << 8) + round(b * 255)
+
+
+def extract_spans(page, backend="rawdict"):
+    """Extract the text spans of a page for word segmentation.
+
+    Args:
+        page: the page
+        backend: "rawdict" builds the full rawdict of the page; "texttrace"
+            reads the flat char tuples of page.get_texttrace(), which is
+            faster and allocates much less.
+    Returns:
+        list of spans, each a dict with "dir", "color" (sRGB int), "size"
+        and "chars", a list of (c, bbox, origin) tuples. Spans of the
+        rawdict backend also carry their "block" number.
+    """
+    spans = []
+    if backend == "rawdict":
+        extr_flags = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE
+        blocks = page.get_text("rawdict", flags=extr_flags)["blocks"]
+        for block in blocks:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    spans.append({
+                        "block": block["number"],
+                        "dir": line["dir"],
+                        "color": span["color"],
+                        "size": span["size"],
+                        "chars": [(c["c"], c["bbox"], c["origin"]) for c in span["chars"]],
+                    })
+    elif backend == "texttrace":
+        # every span type is kept: fill (0), stroke (1) and invisible text
+        # (3, e.g. OCR layers), which rawdict reports as well
+        for span in page.get_texttrace():
+            chars = [(chr(ucs), bbox, origin) for (ucs, gid, origin, bbox) in span["chars"] if ucs >= 0]
+            spans.append({
+                "dir": span["dir"],
+                "color": sRGB_from_trace(span),
+                "size": span["size"],
+                "chars": trace_spaces(chars, span["dir"], span["size"]),
+            })
+    else:
+        raise ValueError("Invalid backend: %s" % backend)
+    return spans
+
+
+def trace_spaces(chars, wdir, size):
+    """Insert the blanks texttrace does not report between words.
+
+    rawdict synthesizes a space where the next char starts noticeably
+    after the end of the previous one. Do the same: a gap of more than
+    TRACE_SPACE_GAP * size along the writing direction, a jump back or a
+    change of the baseline (next line in the same span) separates words.
+    """
+    cos, sin = wdir
+    out = []
+    for i, (c, bbox, origin) in enumerate(chars):
+        if i > 0 and not c.isspace() and not out[-1][0].isspace():
+            prev_bbox, prev_origin = out[-1][1], out[-1][2]
+            # end of the previous char, measured from its origin along wdir
+            prev_end = max((x - prev_origin[0]) * cos + (y - prev_origin[1]) * sin
+                           for x in (prev_bbox[0], prev_bbox[2]) for y in (prev_bbox[1], prev_bbox[3]))
+            dx, dy = origin[0] - prev_origin[0], origin[1] - prev_origin[1]
+            advance = dx * cos + dy * sin
+            shift = abs(dy * cos - dx * sin)  # perpendicular to wdir
+            if advance - prev_end > TRACE_SPACE_GAP * size or advance < 0 or shift > size / 2:
+                out.append((" ", prev_bbox, prev_origin))
+        out.append((c, bbox, origin))
+    return out
+
+
+def split_words(span):
+    """Split the chars of a span into words at white space."""
+    word_list = []
+    for (c, bbox, origin) in span["chars"]:
+        if c.isspace():
+            word_list.append({'bbox': fitz.Rect(0,0,0,0),
+                                'text': '', 'origin': None,
+                                'color': span['color'], 
+                                'size': span['size']})
+        else:
+            if not word_list:
+                word_list.append({'bbox': fitz.Rect(bbox), 
+                                'text': c, 
+                                'origin': origin, 
+                                'color': span['color'], 
+                                'size': span['size']})
+            else:
+                if word_list[-1]['origin'] is None:
+                    word_list[-1]['origin'] = origin
+                word_list[-1]['bbox'] = fitz.Rect(bbox) | word_list[-1]['bbox']
+                word_list[-1]['text'] += c
+    return [word for word in word_list if word['origin'] is not None]
+
+
 def tilted_span(page, wdir, word, font):
     """Output a non-horizontal text span."""
     cos, sin = wdir  # writing direction from the line
@@ -69,13 +229,115 @@ def tilted_span(page, wdir, word, font):
     tw.write_text(page, morph=(origin, matrix))
 
 
-def cont_clean(page, fontrefs):
+def split_content(cont):
+    """Split a /Contents stream into lines as expected by cont_clean.
+
+    Every line is additionally split before each "/" so that font invokers
+    always start a line. Returns None if the stream cannot be processed,
+    i.e. it is empty or not separated by newlines.
+    """
+    cont_line = cont.splitlines()
+    cont_lines = []
+    for line in cont_line:
+        if len(line) == 0:
+            continue
+        parts = line.split(b'/')
+        parts = [b'/' + part for part in parts if part]  # prepend '/' to each part
+        if not line.startswith(b'/'):
+            parts[0] = parts[0][1:]
+        cont_lines.extend(parts)
+
+    if len(cont_lines) == 0 or cont_lines[0] == cont:
+        return None
+    return cont_lines
+
+
+def doc_hash(indoc):
+    """Return the SHA-256 hex digest of the document's file content.
+
+    Accepts a file path or a fitz.Document. Documents opened from memory
+    or modified since opening are hashed via their serialized bytes.
+    """
+    if isinstance(indoc, fitz.Document):
+        if indoc.name and os.path.isfile(indoc.name) and not indoc.is_dirty:
+            indoc = indoc.name
+        else:
+            return hashlib.sha256(indoc.tobytes()).hexdigest()
+    stat = os.stat(indoc)
+    memo_key = (os.path.abspath(indoc), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _hash_memo:  # file unchanged since last time
+        return _hash_memo[memo_key]
+    sha = hashlib.sha256()
+    with open(indoc, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    _hash_memo[memo_key] = sha.hexdigest()
+    return _hash_memo[memo_key]
+
+
+SAVE_PROFILES = {
+    # no garbage collection; an incremental save when writing back to the
+    # opened file, which only appends the changed objects
+    "fast": {"garbage": 0, "deflate": False},
+    # full garbage collection and compression of subset fonts
+    "compact": {"garbage": 4, "deflate": True, "deflate_images": True,
+                "deflate_fonts": True, "subset": True},
+}
+
+save_timings = {}  # profile name -> [number of saves, seconds]
+
+
+def save_document(doc, output, profile="compact"):
+    """Save a document with a save profile and record the time spent.
+
+    Args:
+        doc: the document
+        output: file path, writable file object, or None to return bytes
+        profile: name in SAVE_PROFILES or a dict of Document.save arguments
+    Returns:
+        the PDF bytes if output is None, otherwise None.
+    """
+    name = profile if isinstance(profile, str) else "custom"
+    options = dict(SAVE_PROFILES[profile] if isinstance(profile, str) else profile)
+    t0 = time.perf_counter()
+    if options.pop("subset", False):
+        doc.subset_fonts()
+    data = None
+    same_file = (isinstance(output, str) and doc.name
+                 and os.path.abspath(output) == os.path.abspath(doc.name))
+    if name == "fast" and same_file and doc.can_save_incrementally():
+        doc.saveIncr()
+    elif output is None:
+        data = doc.tobytes(**options)
+    elif same_file:  # MuPDF cannot overwrite the file it reads from
+        tmp_path = output + ".tmp"
+        doc.save(tmp_path, **options)
+        os.replace(tmp_path, output)
+    else:
+        doc.save(output, **options)
+    timing = save_timings.setdefault(name, [0, 0.0])
+    timing[0] += 1
+    timing[1] += time.perf_counter() - t0
+    return data
+
+
+def save_report():
+    """Return a summary of the time spent per save profile."""
+    lines = []
+    for name, (count, seconds) in sorted(save_timings.items()):
+        lines.append("save profile %s: %i saves, %.2fs" % (name, count, seconds))
+    return "\n".join(lines)
+
+
+def cont_clean(page, fontrefs, deadline=None):
     """Remove text written with one of the fonts to replace.
 
     Args:
         page: the page
         fontrefs: dict of contents stream xrefs. Each xref key has a list of
             ref names looking like b"/refname ".
+        deadline: optional time.monotonic() value, BudgetExceeded is raised
+            once it has passed. Streams may then be partially updated.
     """
 
     def remove_font(fontrefs, lines):
@@ -93,6 +355,8 @@ def cont_clean(page, fontrefs):
         for ref in fontrefs:
             found = False  # switch: processing our font
             for i in range(count):
+                if i & 0xFFFF == 0:  # cheap enough to check every 64k lines
+                    check_deadline(deadline)
                 if lines[i] == b"ET":  # end text object
                     found = False  # no longer in found mode
                     continue
@@ -141,18 +405,8 @@ def cont_clean(page, fontrefs):
     
     for (xref, xref0) in xref_list: 
         cont = doc.xref_stream(xref0)
-        cont_line = cont.splitlines()
-        cont_lines = []
-        for line in cont_line:
-            if len(line) == 0:
-                continue
-            parts = line.split(b'/')
-            parts = [b'/' + part for part in parts if part]  # prepend '/' to each part
-            if not line.startswith(b'/'):
-                parts[0] = parts[0][1:]
-            cont_lines.extend(parts)
-
-        if len(cont_lines) == 0 or cont_lines[0] == cont:
+        cont_lines = split_content(cont)
+        if cont_lines is None:
             return False
         changed, cont_lines = remove_font(fontrefs[xref], cont_lines)
         if changed:
@@ -181,16 +435,173 @@ def get_page_fontrefs(page, font_name):
     return fontrefs  # return list of font reference names
 
 
+def is_bbox_list(bbox):
+    """Check whether bbox is a list of bboxes rather than a single one."""
+    return len(bbox) > 0 and isinstance(bbox[0], (list, tuple, fitz.Rect))
+
+
+def render_crops(page, bbox, dpi, bbox_dpi=None):
+    """Crop the page at one or more resolutions.
+
+    The page content is interpreted once into a display list, which is then
+    rasterized for every dpi, restricted to the area of the bboxes.
+
+    Args:
+        page: the (modified) page
+        bbox: a bbox (x1, y1, x2, y2) or a list of bboxes
+        dpi: a resolution or a list of resolutions
+        bbox_dpi: resolution the bboxes are given in, defaults to the
+            (first) dpi
+    Returns:
+        a PIL image if both bbox and dpi are single values. Otherwise a list
+        with one entry per dpi, each being an image or a list of images
+        (one per bbox).
+    """
+    dpis = dpi if isinstance(dpi, (list, tuple)) else [dpi]
+    bboxes = bbox if is_bbox_list(bbox) else [bbox]
+    if bbox_dpi is None:
+        bbox_dpi = dpis[0]
+
+    dl = page.get_displaylist()
+    results = []
+    for render_dpi in dpis:
+        scale = render_dpi / bbox_dpi
+        boxes = [[round(v * scale) for v in b] for b in bboxes]
+        # clip to the area covering all bboxes, in page coordinates
+        zoom = render_dpi / 72
+        clip = fitz.Rect(
+            min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes),
+        ) / zoom
+        clip = clip & dl.rect
+        if clip.is_empty:  # crops lie outside of the page
+            clip = dl.rect
+        pixmap = dl.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+        image = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
+        crops = [image.crop((b[0] - pixmap.x, b[1] - pixmap.y, b[2] - pixmap.x, b[3] - pixmap.y))
+                 for b in boxes]
+        results.append(crops if is_bbox_list(bbox) else crops[0])
+    return results if isinstance(dpi, (list, tuple)) else results[0]
+
+
+def prune_fonts(page):
+    """Drop the font resources of the page its contents no longer use.
+
+    After cont_clean the replaced fonts are still listed in the resources,
+    everything embedding the page would carry them along.
+    """
+    doc = page.parent
+    contents = page.read_contents()
+    fonts = [f for f in page.get_fonts(full=True) if f[-1] == 0]  # page /Contents only
+    if fonts and doc.xref_get_key(page.xref, "Resources/Font")[0] in ("dict", "xref"):
+        used = [f for f in fonts if b"/" + f[4].encode() + b" " in contents]
+        if len(used) < len(fonts):
+            font_dict = "<<%s>>" % "".join("/%s %i 0 R" % (f[4], f[0]) for f in used)
+            # set the key in the object holding it, xref_set_key cannot
+            # write a dict through an indirect /Resources
+            kind, value = doc.xref_get_key(page.xref, "Resources")
+            if kind == "xref":
+                doc.xref_set_key(int(value.split()[0]), "Font", font_dict)
+            else:
+                doc.xref_set_key(page.xref, "Resources/Font", font_dict)
+
+
+def pdf_crops(page, bbox, dpi, bbox_dpi=None):
+    """Crop the page as vector PDFs instead of rasters.
+
+    Each bbox becomes a one-page PDF showing the clipped page, embedded as
+    a form XObject. Only the resources of this page are copied, minus the
+    fonts the page no longer uses, and the fonts are subset to the glyphs
+    used. The crop page has the size of the bbox, as the image crops do;
+    parts of the bbox outside of the page stay blank.
+
+    Args:
+        page: the (modified) page
+        bbox: a bbox (x1, y1, x2, y2) or a list of bboxes
+        dpi: a resolution or a list of resolutions, only used to scale the
+            bboxes (a vector crop has no resolution)
+        bbox_dpi: resolution the bboxes are given in, defaults to the
+            (first) dpi
+    Returns:
+        the PDF bytes of the crop, or a list of them if bbox is a list.
+    """
+    dpis = dpi if isinstance(dpi, (list, tuple)) else [dpi]
+    bboxes = bbox if is_bbox_list(bbox) else [bbox]
+    if bbox_dpi is None:
+        bbox_dpi = dpis[0]
+
+    page_doc = single_page_copy(page.parent, page.number)  # prune a copy, not the caller's page
+    src = page_doc[0]
+    prune_fonts(src)
+    # show_pdf_page shows the page unrotated: the clip is given in unrotated
+    # coordinates and the shown page is turned by the page rotation instead
+    rotation = src.rotation
+    derotate = src.derotation_matrix
+    src.set_rotation(0)
+    crops = []
+    for b in bboxes:
+        rect = fitz.Rect(b) * (72 / bbox_dpi)  # crop in (rotated) page coordinates
+        clip = rect & (src.rect * ~derotate)  # the part of the crop showing the page
+        doc = fitz.open()
+        new_page = doc.new_page(width=rect.width, height=rect.height)
+        if not clip.is_empty:
+            target = clip * fitz.Matrix(1, 0, 0, 1, -rect.x0, -rect.y0)
+            new_page.show_pdf_page(target, page_doc, 0, clip=clip * derotate, rotate=-rotation)
+        doc.subset_fonts()
+        crops.append(doc.tobytes(garbage=4, deflate=True))
+    return crops if is_bbox_list(bbox) else crops[0]
+
+
+def crop_page(page, bbox, dpi, bbox_dpi=None, output="image"):
+    """Crop the page as images (render_crops) or as PDFs (pdf_crops)."""
+    if output == "image":
+        return render_crops(page, bbox, dpi, bbox_dpi)
+    elif output == "pdf":
+        return pdf_crops(page, bbox, dpi, bbox_dpi)
+    else:
+        raise ValueError("Invalid output: %s" % output)
+
+
+def rewrite_page(type, page, font_name, backend="rawdict", deadline=None):
+    """Rewrite the page in place with font_name, using the given mode."""
+    if type == "word":
+        return replace_page_word(page, font_name, backend, deadline)
+    elif type == "line":
+        return replace_page_line(page, font_name, deadline)
+    elif type == "adaptive":
+        return replace_page_word(page, font_name, backend, deadline, ADAPTIVE_TOLERANCE)
+    else:
+        raise ValueError("Invalid type: %s" % type)
+
+
+def single_page_copy(indoc, page_num):
+    """Return a new document holding only a copy of the given page.
+
+    Rewriting the copy leaves the caller's document untouched. Raises
+    IndexError for a page number outside of the document, like indoc[page_num]
+    (insert_pdf would silently clamp it).
+    """
+    page_num = indoc[page_num].number  # range check, negative numbers count from the end
+    doc = fitz.open()
+    doc.insert_pdf(indoc, from_page=page_num, to_page=page_num)
+    return doc
+
+
 def process(type, data):
     if type == "word":
         return process_word(*data)
+    elif type == "adaptive":
+        return process_word(*data, tolerance=ADAPTIVE_TOLERANCE)
     elif type == "line":
         return process_line(*data)
     else:
         raise ValueError("Invalid type: %s" % type)
     
 
-def process_word(indoc, page_num, bbox, font_name, dpi=300):
+def process_word(indoc, page_num, bbox, font_name, dpi=300, bbox_dpi=None, backend="rawdict", output="image",
+                 tolerance=None):
+    # tolerance: write spans as a whole where their words keep their
+    # positions within tolerance * fontsize (adaptive mode), see span_as_word
     assert isinstance(indoc, fitz.Document)
     assert isinstance(page_num, int)
     assert isinstance(font_name, str)
@@ -198,90 +609,283 @@ def process_word(indoc, page_num, bbox, font_name, dpi=300):
     if font_name == "random":
         font_name = random_font()
 
-    extr_flags = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE
-    font = fitz.Font(font_name)
     page = indoc[page_num]
-    blocks = page.get_text("rawdict", flags=extr_flags)["blocks"]
+    if not replace_page_word(page, font_name, backend, tolerance=tolerance):
+        return None
+
+    # Crop the image
+    return crop_page(page, bbox, dpi, bbox_dpi, output)
+
+
+def replace_page_word(page, font_name, backend="rawdict", deadline=None, tolerance=None):
+    """Rewrite all text of the page with font_name, word by word.
+
+    Args:
+        backend: text extraction backend, see extract_spans
+        deadline: optional time.monotonic() value, see cont_clean
+        tolerance: write spans as a whole where possible, see write_words
+    Returns:
+        True if the page was rewritten, False if it cannot be processed.
+    """
+    font = get_font(font_name)
+    spans = extract_spans(page, backend)
+    check_deadline(deadline)
 
     fontrefs = get_page_fontrefs(page, font_name)
     if fontrefs == {}:  # page has no fonts to replace
-        print("Given PDF does not contain any fonts", page_num)
-        return None
+        print("Given PDF does not contain any fonts", page.number)
+        return False
     
-    valid = cont_clean(page, fontrefs)  # remove text using fonts to be replaced
+    valid = cont_clean(page, fontrefs, deadline)  # remove text using fonts to be replaced
     if not valid:
         print("Cannot process this file.")
-        return None
+        return False
     
+    write_words(page, spans, font, deadline=deadline, tolerance=tolerance)
+    return True
+
+
+# PyMuPDF internals used by write_text_merged, as by TextWriter.write_text
+_MERGED_WRITE_API = ("mupdf", "JM_color_FromSequence", "JM_merge_resources",
+                     "JM_EscapeStrFromBuffer", "TOOLS", "repair_mono_font")
+
+
+def write_text_merged(page, textwriters):
+    """Write the text writers of all colors as one content stream.
+
+    TextWriter.write_text adds a new /Contents stream and new font resources
+    for every call, i.e. for every text color. Here all writers are filled
+    into a single PDF device instead, which switches colors inline and
+    references every font once. This relies on the PyMuPDF internals used
+    by write_text itself (_MERGED_WRITE_API); if any of them is missing or
+    fails before the page is modified, writers are written one by one.
+
+    Args:
+        page: the page
+        textwriters: dict of sRGB color -> fitz.TextWriter
+    """
+    if not textwriters:
+        return
+    internals = all(hasattr(fitz, name) for name in _MERGED_WRITE_API)
+    internals = internals and hasattr(page, "_pdf_page") and hasattr(fitz.TOOLS, "_insert_contents")
+    if internals:
+        try:  # fill the device; the page itself is not touched yet
+            mupdf = fitz.mupdf
+            pdfpage = page._pdf_page()
+            resources = mupdf.pdf_new_dict(pdfpage.doc(), 5)
+            contents = mupdf.fz_new_buffer(1024)
+            dev = mupdf.pdf_new_pdf_device(pdfpage.doc(), mupdf.FzMatrix(), resources, contents)
+            for color, tw in textwriters.items():
+                ncol, dev_color = fitz.JM_color_FromSequence(fitz.sRGB_to_pdf(color))
+                mupdf.fz_fill_text(dev, tw.this, mupdf.FzMatrix(), mupdf.fz_device_rgb(), dev_color, 1,
+                                   mupdf.FzColorParams(mupdf.fz_default_color_params))
+            mupdf.fz_close_device(dev)
+        except (AttributeError, TypeError):  # internals changed in this PyMuPDF version
+            internals = False
+    if not internals:
+        for color in textwriters.keys():  # output the stored text per color
+            tw = textwriters[color]
+            outcolor = fitz.sRGB_to_pdf(color)  # recover (r,g,b)
+            tw.write_text(page, color=outcolor)
+        return
+
+    max_alp, max_font = fitz.JM_merge_resources(pdfpage, resources)  # rename into page resources
+
+    # same post-processing as TextWriter.write_text
+    cont_lines = ["q"]
+    cb = page.cropbox_position
+    delta = page.rect.height - page.rect.width if page.rotation in (90, 270) else 0
+    mb = page.mediabox
+    if bool(cb) or mb.y0 != 0 or delta != 0:
+        cont_lines.append("1 0 0 1 %g %g cm" % (cb.x, cb.y + mb.y0 - delta))
+    for line in fitz.JM_EscapeStrFromBuffer(contents).splitlines():
+        if line.endswith(" cm"):
+            continue
+        if line == "BT":
+            cont_lines.append(line)
+            cont_lines.append("0 Tr")
+            continue
+        if line.endswith(" gs"):
+            line = "/Alp%i gs" % (int(line.split()[0][4:]) + max_alp)
+        elif line.endswith(" Tf"):
+            temp = line.split()
+            cont_lines.append("1 w")
+            line = " ".join(["/F%i" % (int(temp[0][2:]) + max_font)] + temp[1:])
+        elif line.endswith(" rg"):
+            cont_lines.append(line.replace("rg", "RG"))
+        cont_lines.append(line)
+    cont_lines.append("Q\n")
+    fitz.TOOLS._insert_contents(page, "\n".join(cont_lines).encode("utf-8"), overlay=1)
+    for tw in textwriters.values():
+        for font in tw.used_fonts:
+            fitz.repair_mono_font(page, font)
+
+
+def span_as_word(span, font, tolerance):
+    """Return the whole span as one word if writing it at once is faithful.
+
+    The span is written at the fontsize fitting its bbox width. If no word
+    start then moves by more than tolerance * fontsize from its original
+    position, the span is returned as a single word dict, otherwise None.
+    """
+    chars = span["chars"]
+    if not chars:
+        return None
+    text = "".join(c for (c, bbox, origin) in chars)
+    rect = fitz.Rect()
+    for (c, bbox, origin) in chars:
+        rect |= fitz.Rect(bbox)
+    tl = font.text_length(text, fontsize=span["size"])
+    if tl <= 0:
+        return None
+    fontsize = min(span["size"], rect.width / tl * span["size"])
+
+    # predicted x of every word start vs. its original origin
+    x = chars[0][2][0]
+    shift = 0
+    prev_space = True
+    for (c, bbox, origin), width in zip(chars, font.char_lengths(text, fontsize=fontsize)):
+        if prev_space and not c.isspace():
+            shift = max(shift, abs(x - origin[0]))
+        prev_space = c.isspace()
+        x += width
+    if shift > tolerance * span["size"]:
+        return None
+    return {'bbox': rect, 'text': text, 'origin': chars[0][2],
+            'color': span['color'], 'size': span['size']}
+
+
+def write_words(page, spans, font, pick_font=None, deadline=None, tolerance=None):
+    """Write the words of the extracted spans with the replacement font.
+
+    Args:
+        page: the page, already cleaned by cont_clean
+        spans: spans of extract_spans
+        font: the replacement fitz.Font
+        pick_font: optional function (span, word) -> fitz.Font choosing
+            another font for a word. A single text writer may hold words
+            in several fonts.
+        deadline: optional time.monotonic() value, see cont_clean
+        tolerance: if given, horizontal spans are written as a whole when
+            their words shift by at most tolerance * fontsize (see
+            span_as_word), otherwise word by word.
+    """
     textwriters = {}  # contains one text writer per detected text color
 
-    for block in blocks:
-        for line in block["lines"]:
-            wmode = line["wmode"] # writing mode (horizontal, vertical)
-            wdir = list(line["dir"]) # writing direction
-            for span in line["spans"]:
-                span_char = span['chars']
-
-                word_list = []
-                for character in span_char:
-                    if character['c'].isspace():
-                        word_list.append({'bbox': fitz.Rect(0,0,0,0),
-                                            'text': '', 'origin': None,
-                                            'color': span['color'], 
-                                            'size': span['size']})
-                    else:
-                        if not word_list:
-                            word_list.append({'bbox': fitz.Rect(character['bbox']), 
-                                            'text': character['c'], 
-                                            'origin': character['origin'], 
-                                            'color': span['color'], 
-                                            'size': span['size']})
-                        else:
-                            if word_list[-1]['origin'] is None:
-                                word_list[-1]['origin'] = character['origin']
-                            word_list[-1]['bbox'] = fitz.Rect(character['bbox']) | word_list[-1]['bbox']
-                            word_list[-1]['text'] += character['c']
-                word_list_cleaned = [word for word in word_list if word['origin'] is not None]
-
-                for word in word_list_cleaned:
-                    text = word["text"].replace(chr(0xFFFD), chr(0xB6))
-                    # guard against non-utf8 characters
-                    textb = text.encode("utf8", errors="backslashreplace")
-                    text = textb.decode("utf8", errors="backslashreplace")
-
-                    if wdir != [1, 0]:  # special treatment for tilted text
-                        tilted_span(page, wdir, word, font)
-                        continue
-
-                    if word['color'] in textwriters.keys():  # already have a textwriter?
-                        tw = textwriters[word['color']]  # re-use it
-                    else:  # make new
-                        tw = fitz.TextWriter(page.rect)  # make text writer
-                        textwriters[word['color']] = tw  # store it for later use
-                    try:
-                        tw.append(
-                            word["origin"],
-                            text,
-                            font=font,
-                            fontsize=min(span['size'],resize(word, font)),  # use adjusted fontsize
-                        )
-                    except:
-                        print("page %i exception:" % page.number, text)
+    for span in spans:
+        check_deadline(deadline)
+        wdir = list(span["dir"]) # writing direction
+        words = None
+        if tolerance is not None and pick_font is None and wdir == [1, 0]:
+            unit = span_as_word(span, font, tolerance)
+            if unit is not None:  # fast path: one append for the span
+                words = [unit]
+        if words is None:
+            words = split_words(span)
+        for word in words:
+            text = word["text"].replace(chr(0xFFFD), chr(0xB6))
+            # guard against non-utf8 characters
+            textb = text.encode("utf8", errors="backslashreplace")
+            text = textb.decode("utf8", errors="backslashreplace")
+            word_font = pick_font(span, word) if pick_font else font
+
+            if wdir != [1, 0]:  # special treatment for tilted text
+                tilted_span(page, wdir, word, word_font)
+                continue
+
+            if word['color'] in textwriters.keys():  # already have a textwriter?
+                tw = textwriters[word['color']]  # re-use it
+            else:  # make new
+                tw = fitz.TextWriter(page.rect)  # make text writer
+                textwriters[word['color']] = tw  # store it for later use
+            try:
+                tw.append(
+                    word["origin"],
+                    text,
+                    font=word_font,
+                    fontsize=min(span['size'],resize(word, word_font)),  # use adjusted fontsize
+                )
+            except:
+                print("page %i exception:" % page.number, text)
 
     # now write all text stored in the list of text writers
-    for color in textwriters.keys():  # output the stored text per color
-        tw = textwriters[color]
-        outcolor = fitz.sRGB_to_pdf(color)  # recover (r,g,b)
-        tw.write_text(page, color=outcolor)
+    write_text_merged(page, textwriters)
+
+
+def replace_page_regions(page, region_fonts, default_font, backend="rawdict", region_scale=1):
+    """Rewrite the page with a different font per region in a single pass.
+
+    Args:
+        page: the page
+        region_fonts: dict mapping regions to font names. A region is
+            either a block number (int, "rawdict" backend only) or a rect
+            (x0, y0, x1, y1). A word belongs to the first rect containing
+            its center, otherwise to its block.
+        default_font: font name for words outside of all regions
+        region_scale: factor converting region rects to page coordinates,
+            e.g. 72 / dpi for pixel coordinates
+    Returns:
+        True if the page was rewritten, False if it cannot be processed.
+    """
+    rects, blocks = [], {}
+    for region, font_name in region_fonts.items():
+        if font_name == "random":
+            font_name = random_font()
+        if isinstance(region, int):
+            if backend != "rawdict":
+                raise ValueError("Block regions need the rawdict backend")
+            blocks[region] = get_font(font_name)
+        else:
+            rects.append((fitz.Rect(region) * region_scale, get_font(font_name)))
+    if default_font == "random":
+        default_font = random_font()
+    font = get_font(default_font)
+
+    def pick_font(span, word):
+        center = (word["bbox"].tl + word["bbox"].br) / 2
+        for rect, region_font in rects:
+            if center in rect:
+                return region_font
+        return blocks.get(span.get("block"), font)
+
+    spans = extract_spans(page, backend)
+
+    fontrefs = get_page_fontrefs(page, None)  # all text is rewritten
+    if fontrefs == {}:  # page has no fonts to replace
+        print("Given PDF does not contain any fonts", page.number)
+        return False
+
+    valid = cont_clean(page, fontrefs)  # remove text in all fonts
+    if not valid:
+        print("Cannot process this file.")
+        return False
+
+    write_words(page, spans, font, pick_font)
+    return True
+
+
+def process_regions(indoc, page_num, bbox, region_fonts, default_font, dpi=300, bbox_dpi=None, backend="rawdict", output="image"):
+    """Like process_word, with fonts assigned per region of the page.
+
+    Region rects are given in the same coordinates as bbox. See
+    replace_page_regions.
+    """
+    assert isinstance(indoc, fitz.Document)
+    assert isinstance(page_num, int)
+    assert isinstance(default_font, str)
+
+    dpis = dpi if isinstance(dpi, (list, tuple)) else [dpi]
+    page = indoc[page_num]
+    region_scale = 72 / (bbox_dpi or dpis[0])
+    if not replace_page_regions(page, region_fonts, default_font, backend, region_scale):
+        return None
 
     # Crop the image
-    pixmap = indoc[page_num].get_pixmap(dpi=dpi)
-    image = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
-    image = image.crop(bbox)
-    return image
+    return crop_page(page, bbox, dpi, bbox_dpi, output)
 
 
-def process_line(indoc, page_num, bbox, font_name, dpi=300):
+def process_line(indoc, page_num, bbox, font_name, dpi=300, bbox_dpi=None, backend=None, output="image"):
+    # backend is accepted for symmetry with process_word, spans come from "dict"
     assert isinstance(indoc, fitz.Document)
     assert isinstance(page_num, int)
     assert isinstance(font_name, str)
@@ -289,24 +893,41 @@ def process_line(indoc, page_num, bbox, font_name, dpi=300):
     if font_name == "random":
         font_name = random_font()
 
-    extr_flags = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE
-    font = fitz.Font(font_name)
     page = indoc[page_num]
+    if not replace_page_line(page, font_name):
+        return None
+
+    # Crop the image
+    return crop_page(page, bbox, dpi, bbox_dpi, output)
+
+
+def replace_page_line(page, font_name, deadline=None):
+    """Rewrite all text of the page with font_name, span by span.
+
+    Args:
+        deadline: optional time.monotonic() value, see cont_clean
+    Returns:
+        True if the page was rewritten, False if it cannot be processed.
+    """
+    extr_flags = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE
+    font = get_font(font_name)
     blocks = page.get_text("dict", flags=extr_flags)["blocks"]
+    check_deadline(deadline)
 
     fontrefs = get_page_fontrefs(page, font_name)
     if fontrefs == {}:  # page has no fonts to replace
-        print("Given PDF does not contain any fonts", page_num)
-        return None
+        print("Given PDF does not contain any fonts", page.number)
+        return False
     
-    valid = cont_clean(page, fontrefs)  # remove text using fonts to be replaced
+    valid = cont_clean(page, fontrefs, deadline)  # remove text using fonts to be replaced
     if not valid:
         print("Cannot process this file.")
-        return None
+        return False
     
     textwriters = {}  # contains one text writer per detected text color
 
     for block in blocks:
+        check_deadline(deadline)
         for line in block["lines"]:
             wmode = line["wmode"] # writing mode (horizontal, vertical)
             wdir = list(line["dir"]) # writing direction
@@ -336,37 +957,34 @@ def process_line(indoc, page_num, bbox, font_name, dpi=300):
                     print("page %i exception:" % page.number, text)
 
     # now write all text stored in the list of text writers
-    for color in textwriters.keys():  # output the stored text per color
-        tw = textwriters[color]
-        outcolor = fitz.sRGB_to_pdf(color)  # recover (r,g,b)
-        tw.write_text(page, color=outcolor)
-
-    # Crop the image
-    pixmap = indoc[page_num].get_pixmap(dpi=dpi)
-    image = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
-    image = image.crop(bbox)
-    return image
+    write_text_merged(page, textwriters)
+    return True
 
 
-def replace_font(indoc, page_num, bbox, font_name, dpi): 
+def replace_font(indoc, page_num, bbox, font_name, dpi, mode="word", bbox_dpi=None, backend="rawdict", output="image"):
     """Replace font in a PDF page"""
 
     # indoc: input PDF document
     # page_num: page number to replace font
-    # bbox: The bounding box to crop the image (x1, y1, x2, y2)
+    # bbox: The bounding box to crop the image (x1, y1, x2, y2), or a list of them
     # font_name: font name to replace
     # dpi: resolution of the output image (bbox must be specified in the same resolution as dpi). 
     # If you dont know the dpi, you can use get_dpi function to get the dpi of the page.
-    # output: A cropped PIL image of the specified page and bounding box.
+    # A list of dpis renders the same crops at every resolution, the page is only interpreted once.
+    # mode: "word", "line" or "adaptive" (line-level where it keeps word positions, see benchmark.py for a comparison)
+    # bbox_dpi: resolution of bbox if it differs from dpi (defaults to the first dpi)
+    # backend: text extraction of word mode, "rawdict" or the lighter "texttrace"
+    # output: "image" returns a cropped PIL image of the specified page and bounding box,
+    # "pdf" the crop as one-page vector PDF bytes (fonts subset, see pdf_crops).
+    # For lists of dpis and/or bboxes, see render_crops.
 
-    mode = "word" # mode = "word" or "line"
     if isinstance(page_num, int):
-        return process(mode, (indoc, page_num, bbox, font_name, dpi))
+        return process(mode, (indoc, page_num, bbox, font_name, dpi, bbox_dpi, backend, output))
     
     elif isinstance(page_num, list):
         return_list = []
         for page in page_num:
-            return_list.append(process(mode, (indoc, page, bbox, font_name, dpi)))
+            return_list.append(process(mode, (indoc, page, bbox, font_name, dpi, bbox_dpi, backend, output)))
         return return_list
 
 